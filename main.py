@@ -1,14 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import yt_dlp
-import requests
+import httpx
+import orjson
 import os
+import asyncio
 import random
 import shutil
+import tempfile
 import re
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse, parse_qs
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware  
+from fastapi.middleware.gzip import GZipMiddleware
 
 load_dotenv()
 
@@ -22,16 +34,111 @@ PIPED_INSTANCES = [
     "https://pipedapi.in.projectsegfau.lt",
     "https://pipedapi.brighteon.wtf"
 ]
+_PIPED_PREFIXES = tuple(i + "/streams/" for i in PIPED_INSTANCES)
+# Bound str.__mod__ of fixed templates: _WATCH_URL(video_id) -> full URL
+_WATCH_URL = "https://www.youtube.com/watch?v=%s".__mod__
+_THUMB_URL = "https://img.youtube.com/vi/%s/hqdefault.jpg".__mod__
+
+# Query rotations behind /popular and /recommendations
+TRENDING_QUERIES = (
+    "Bollywood top hits 2025", "Indian music chart", "Bollywood songs playlist",
+    "Top Hindi songs 2025", "Popular Indian tracks"
+)
+BASE_QUERIES = (
+    "Bollywood romantic songs", "Relaxing Hindi music", "Indian pop hits",
+    "Bollywood trending songs", "Acoustic Hindi covers", "Top Hindi tracks"
+)
+
+# Keywords behind _MUSIC_RE and _INDIAN_MUSIC_RE
+MUSIC_KEYWORDS = ("music", "song", "audio", "track")
+BW_KEYWORDS = MUSIC_KEYWORDS + ("bollywood", "hindi")
+
+# How long Piped gets to answer before yt-dlp is raced against it, and how
+# long the whole race may take before the lookup gives up
+HEDGE_DELAY = 0.4
+RESOLVE_TIMEOUT = 30
+
+# Piped circuit breaker: consecutive failures and skip-until time per instance
+PIPED_MAX_FAILURES = 3
+PIPED_COOLDOWN = 60
+_piped_failures = {}  # prefix -> consecutive failures
+_piped_down_until = {}  # prefix -> time.monotonic() deadline
+
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; serena-backend)",
+    "Accept-Encoding": "gzip",
+}
+
+# Shared HTTP/2 connection pools; repeat hits to the same hosts skip TCP+TLS setup.
+# SYNC_CLIENT serves the blocking audio body streaming,
+# CLIENT the async Piped lookups and keep-alive ping.
+_CLIENT_OPTS = dict(
+    http2=True,
+    timeout=3.0,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    headers=HTTP_HEADERS,
+)
+SYNC_CLIENT = httpx.Client(**_CLIENT_OPTS)
+CLIENT = httpx.AsyncClient(**_CLIENT_OPTS)
+# Spotify gets its own pools so token + track calls stay on warm HTTP/2 connections
+_SPOTIFY_AUTH = httpx.AsyncClient(http2=True, timeout=10, base_url="https://accounts.spotify.com")
+_SPOTIFY = httpx.AsyncClient(http2=True, timeout=10, base_url="https://api.spotify.com")
+
+# Compiled once; used on every search / stream request
+_VID_RE = re.compile(r"(?:v=|youtu\.be/)([A-Za-z0-9_-]+)")
+_YT_LINK_RE = re.compile(r"youtube\.com|youtu\.be")
+_SPOTIFY_TRACK_RE = re.compile(r"/track/([A-Za-z0-9]+)")
+# Keyword filters for "looks like a music video"; matched against title and artist
+_MUSIC_RE = re.compile("|".join(MUSIC_KEYWORDS), re.IGNORECASE)
+_INDIAN_MUSIC_RE = re.compile("|".join(BW_KEYWORDS), re.IGNORECASE)
+
+# -------------------- RESULT CACHES --------------------
+# googlevideo URLs expire after ~6h; keep resolved audio URLs a bit less than that
+AUDIO_URL_TTL = 5 * 3600
+SEARCH_TTL = 30 * 60
+# Keyword-filtered endpoints ask yt-dlp for this many times the results they
+# return, so filtering still leaves a full page
+SEARCH_OVERFETCH = 2
+
+_audio_url_cache = TTLCache(maxsize=2048, ttl=AUDIO_URL_TTL)  # video_id -> (url, expires_at)
+_search_cache = TTLCache(maxsize=256, ttl=SEARCH_TTL)  # (normalized query, limit) -> songs
+_metadata_cache = TTLCache(maxsize=1024, ttl=SEARCH_TTL)  # video_id -> song
+_inflight_resolves = {}  # video_id -> asyncio.Task resolving it
+_spotify_token_cache = {"token": None, "expires_at": 0.0}
+_spotify_token_lock = asyncio.Lock()
+_popular_feed = {}  # query -> filtered songs
+_popular_pool = []  # songs from every trending query, deduplicated by url
+_recommendations_feed = {}  # query -> filtered songs
+_cache_lock = threading.Lock()
 
 # -------------------- COOKIES HANDLING --------------------
 COOKIES_FILE = os.getenv("COOKIES_FILE")
 
+def copy_cookies_once(src: str, dst: str):
+    """
+    Copy src to dst unless it is already there. The lock file makes sure that
+    with several workers only the first one copies and the rest reuse it.
+    """
+    try:
+        import fcntl
+    except ImportError:  # Windows: no flock, single worker
+        fcntl = None
+
+    with open(dst + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(dst):
+            shutil.copy(src, dst + ".tmp")
+            os.replace(dst + ".tmp", dst)
+
 if COOKIES_FILE:
-    # On Render, /etc/secrets/cookies.txt is read-only → copy it
-    writable_path = os.path.join(BASE_DIR, "cookies.txt")
+    # On Render, /etc/secrets/cookies.txt is read-only → copy it. yt-dlp writes
+    # cookies back, so a symlink would not do; tmpfs keeps its reads off disk.
+    cookies_dir = "/dev/shm" if os.path.isdir("/dev/shm") else BASE_DIR
+    writable_path = os.path.join(cookies_dir, "serena-cookies.txt")
     try:
-        if not os.path.exists(writable_path):
-            shutil.copy(COOKIES_FILE, writable_path)
+        copy_cookies_once(COOKIES_FILE, writable_path)
         COOKIES_FILE = writable_path
     except Exception as e:
         print(f"Warning: failed to copy cookies file: {e}")
@@ -42,7 +149,157 @@ else:
 
 # ----------------------------------------------------------
 
-app = FastAPI()
+# -------------------- YT-DLP --------------------
+# Checked once at startup instead of stat()-ing the file on every extraction
+_COOKIES_PATH = COOKIES_FILE if COOKIES_FILE and os.path.exists(COOKIES_FILE) else None
+_COOKIE_OPTS = {"cookiefile": _COOKIES_PATH} if _COOKIES_PATH else {}
+
+_SEARCH_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "extract_flat": True,
+    "noplaylist": True,
+    "forcejson": True,
+    **_COOKIE_OPTS,
+}
+# Single-video URL lookups need the full info dict (uploader, thumbnail), not
+# the flat search entry
+_VIDEO_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "noplaylist": True,
+    **_COOKIE_OPTS,
+}
+_RESOLVE_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    # yt-dlp picks the format, so the chosen URL is on the top-level info dict
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    **_COOKIE_OPTS,
+}
+
+# Dedicated pool for blocking yt-dlp work, so slow extractions cannot
+# starve the default threadpool that serves sync endpoints and file I/O.
+# Threads by default; YDL_EXECUTOR=process moves extraction into
+# YDL_PROCESSES worker processes to get yt-dlp's CPU-bound parsing off the
+# event loop's GIL. Each worker re-imports this module, so keep the count
+# small on memory-limited hosts. Bursts beyond the pool size queue on the
+# semaphore instead of hammering YouTube.
+YDL_MAX_CONC = int(os.getenv("YDL_MAX_CONC", "8"))
+YDL_EXECUTOR = os.getenv("YDL_EXECUTOR", "thread")
+YDL_PROCESSES = int(os.getenv("YDL_PROCESSES", "2"))
+YDL_WORKERS = min(YDL_MAX_CONC, YDL_PROCESSES) if YDL_EXECUTOR == "process" else YDL_MAX_CONC
+
+def _new_ydl_pool():
+    if YDL_EXECUTOR == "process":
+        # spawn, not fork: the parent has a running event loop and open HTTP/2 clients
+        return ProcessPoolExecutor(
+            max_workers=YDL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return ThreadPoolExecutor(max_workers=YDL_WORKERS, thread_name_prefix="ydl")
+
+_YDL_POOL = None  # created in lifespan, shut down when it ends
+# One slot per pool worker, so _ydl_running counts jobs actually executing
+YDL_SEM = asyncio.Semaphore(YDL_WORKERS)
+_ydl_running = 0
+_ydl_waiting = 0
+
+# yt-dlp fallback extractions are coalesced by extract_batcher()
+EXTRACT_BATCH_WINDOW = 0.01
+EXTRACT_MAX_BATCH = 8
+_extract_queue = None  # asyncio.Queue of (video_id, future), created in lifespan
+_extract_tasks = set()
+
+# One long-lived YoutubeDL per pool worker and option set. Construction loads
+# every extractor and the cookie jar, and an instance must not run two
+# extract_info calls at once, so each worker thread keeps its own.
+_ydl_local = threading.local()
+
+def get_ydl(name: str, opts: dict):
+    """This thread's YoutubeDL for the given option set, built on first use"""
+    ydl = getattr(_ydl_local, name, None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(opts)
+        setattr(_ydl_local, name, ydl)
+    return ydl
+
+def _call_in_worker(func, *args):
+    """
+    Run func in a pool worker. yt-dlp's exceptions hold references to its
+    logger and can't be pickled back to the parent, so they are re-raised
+    as plain exceptions carrying the original message.
+    """
+    try:
+        return func(*args)
+    except Exception as e:
+        raise Exception(str(e)) from None
+
+async def run_ydl(func, *args):
+    """Run a blocking yt-dlp helper on the dedicated pool, one call per pool worker.
+    func must be a module-level function with picklable arguments and result."""
+    global _ydl_running, _ydl_waiting, _YDL_POOL
+    loop = asyncio.get_running_loop()
+    _ydl_waiting += 1
+    try:
+        await YDL_SEM.acquire()
+    finally:
+        _ydl_waiting -= 1
+
+    _ydl_running += 1
+    pool = _YDL_POOL
+    try:
+        if YDL_EXECUTOR == "process":
+            return await loop.run_in_executor(pool, _call_in_worker, func, *args)
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); the pool is unusable from now on,
+        # so replace it once for everyone and fail just this call
+        if _YDL_POOL is pool:
+            print("[YDL] Worker process died, recreating the pool")
+            _YDL_POOL = _new_ydl_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        _ydl_running -= 1
+        YDL_SEM.release()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the background tasks; on shutdown stop them, then close the HTTP clients"""
+    global _YDL_POOL, _extract_queue, _feed_refresh_sem, _keep_awake_stop
+    _YDL_POOL = _new_ydl_pool()
+    # Built here rather than at import: asyncio primitives bind to the first
+    # loop that waits on them, and each lifespan (e.g. a TestClient per test)
+    # may run on a fresh loop
+    _extract_queue = asyncio.Queue()
+    _feed_refresh_sem = asyncio.Semaphore(FEED_REFRESH_CONC)
+    _keep_awake_stop = asyncio.Event()
+
+    feed_task = asyncio.create_task(refresh_feeds())
+    batcher_task = asyncio.create_task(extract_batcher())
+    keep_awake_task = None
+    if claim_keep_awake():
+        keep_awake_task = asyncio.create_task(keep_server_awake())
+    else:
+        print("[PING] Another worker owns the keep-alive ping")
+
+    yield
+
+    feed_task.cancel()
+    batcher_task.cancel()
+    _keep_awake_stop.set()
+    if keep_awake_task:
+        await keep_awake_task
+        release_keep_awake()
+    _YDL_POOL.shutdown(wait=False, cancel_futures=True)
+    SYNC_CLIENT.close()
+    await CLIENT.aclose()
+    await _SPOTIFY_AUTH.aclose()
+    await _SPOTIFY.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -51,37 +308,56 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# JSON result lists compress ~5x; Starlette >= 1.5 leaves audio/* responses alone
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
 
 # Ensure downloads folder exists
 os.makedirs("downloads", exist_ok=True)
 
 
-class SearchRequest(BaseModel):
-    query: str
-
 class DownloadRequest(BaseModel):
     url: str
 
 # ------------------------- HELPERS -------------------------
 
-def get_spotify_token():
-    auth_response = requests.post(
-        "https://accounts.spotify.com/api/token",
+async def get_spotify_token():
+    """Client-credentials token, reused until 30s before Spotify says it expires"""
+    if time.monotonic() < _spotify_token_cache["expires_at"] - 30:
+        return _spotify_token_cache["token"]
+
+    async with _spotify_token_lock:
+        # Another request may have refreshed it while we waited for the lock
+        if time.monotonic() < _spotify_token_cache["expires_at"] - 30:
+            return _spotify_token_cache["token"]
+        return await _fetch_spotify_token()
+
+async def _fetch_spotify_token():
+    auth_response = await _SPOTIFY_AUTH.post(
+        "/api/token",
         data={"grant_type": "client_credentials"},
-        auth=(CLIENT_ID, CLIENT_SECRET)
+        auth=(CLIENT_ID, CLIENT_SECRET),
     )
     if auth_response.status_code != 200:
         raise Exception("Failed to get Spotify token")
-    return auth_response.json().get("access_token")
+    data = orjson.loads(auth_response.content)
+    _spotify_token_cache["token"] = data.get("access_token")
+    _spotify_token_cache["expires_at"] = time.monotonic() + data.get("expires_in", 3600)
+    return _spotify_token_cache["token"]
+
+def extract_spotify_track_id(url: str):
+    """Extracts the track id from an open.spotify.com/track/... link"""
+    match = _SPOTIFY_TRACK_RE.search(url)
+    if not match:
+        raise Exception("Invalid Spotify track URL")
+    return match.group(1)
 
-def get_spotify_metadata(track_url: str):
-    token = get_spotify_token()
-    track_id = track_url.split("/")[-1].split("?")[0]
+async def get_spotify_metadata(track_id: str):
+    token = await get_spotify_token()
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"https://api.spotify.com/v1/tracks/{track_id}", headers=headers)
+    response = await _SPOTIFY.get(f"/v1/tracks/{track_id}", headers=headers)
     if response.status_code != 200:
         raise Exception("Failed to fetch Spotify metadata")
-    data = response.json()
+    data = orjson.loads(response.content)
     title = data["name"]
     artist = data["artists"][0]["name"]
     duration_sec = data["duration_ms"] // 1000
@@ -92,66 +368,319 @@ def get_spotify_metadata(track_url: str):
         "duration": duration_sec
     }
 
-def youtube_search(query: str, limit: int = 10):
-    """Search or fetch YouTube videos using cookies"""
-    opts = {
-        "quiet": True,
-        "skip_download": True,
-        "extract_flat": True,
-        "noplaylist": True,
-        "forcejson": True,
-        "cookiefile": COOKIES_FILE,   # <-- Added cookies support
+def _song_entry(e: dict):
+    """A yt-dlp info dict or flat entry as a search result"""
+    return {
+        "title": e.get("title") or "Unknown",
+        "artist": e.get("uploader") or "Unknown Artist",
+        "thumbnail": e.get("thumbnail") or _THUMB_URL(e["id"]),
+        "url": _WATCH_URL(e["id"]),
     }
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        if "youtube.com" in query or "youtu.be" in query:
-            results = ydl.extract_info(query, download=False)
-            entries = [results]
-        else:
-            results = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
-            entries = results.get("entries", [results])
-
-    songs = []
-    for entry in entries[:limit]:
-        video_id = entry.get("id")
-        thumbnail = entry.get("thumbnail") or (f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg" if video_id else "")
-        songs.append({
-            "title": entry.get("title") or "Unknown",
-            "artist": entry.get("uploader") or "Unknown Artist",
-            "thumbnail": thumbnail,
-            "url": f"https://www.youtube.com/watch?v={video_id}" if video_id else "",
-        })
+
+def _extract_flat(target: str, limit: int, opts_name: str = "search", opts: dict = _SEARCH_OPTS):
+    """Flat extraction of a ytsearch, playlist or channel: ids and titles only,
+    no per-video page fetches"""
+    results = get_ydl(opts_name, opts).extract_info(target, download=False)
+    # An empty search or playlist has no results; only a non-playlist
+    # (single video) result stands in for its own entry
+    if results.get("_type") == "playlist":
+        entries = results.get("entries") or []
+    else:
+        entries = [results]
+    return [_song_entry(e) for e in list(entries)[:limit] if e.get("id")]
+
+def _resolve_single(url: str):
+    """Full extraction of one YouTube video URL"""
+    info = get_ydl("video", _VIDEO_OPTS).extract_info(url, download=False)
+    return [_song_entry(info)] if info and info.get("id") else []
+
+def youtube_search(query: str, limit: int = 10):
+    """Search or fetch YouTube videos using cookies. Runs in the yt-dlp pool"""
+    if not _YT_LINK_RE.search(query):
+        return _extract_flat(f"ytsearch{limit}:{query}", limit)
+    # Only single-video links get the full extraction; playlist and channel
+    # links would otherwise fully extract every video they contain
+    if _VID_RE.search(query):
+        return _resolve_single(query)
+    # playlistend stops yt-dlp paging through a whole channel for `limit` entries
+    return _extract_flat(query, limit, f"links{limit}", {**_SEARCH_OPTS, "playlistend": limit})
+
+async def search_youtube(query: str, limit: int = 10, use_cache: bool = True):
+    """youtube_search() on the yt-dlp pool, through the search cache"""
+    # Case / whitespace variants of the same text query share one entry;
+    # links are kept verbatim since video ids are case-sensitive
+    if _YT_LINK_RE.search(query):
+        key = (query.strip(), limit)
+    else:
+        key = (" ".join(query.lower().split()), limit)
+    if use_cache:
+        with _cache_lock:
+            cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
+
+    songs = await run_ydl(youtube_search, query, limit)
+    with _cache_lock:
+        _search_cache[key] = songs
     return songs
 
+async def build_feed(query: str, limit: int, use_cache: bool = True):
+    """Search results for a /popular or /recommendations query, filtered to likely music videos"""
+    raw_results = await search_youtube(query, limit * SEARCH_OVERFETCH, use_cache)
+    return filter_music(raw_results, _INDIAN_MUSIC_RE)[:limit]
+
+def filter_music(songs: list, pattern: re.Pattern):
+    """Keep songs whose title or artist matches one of the keywords in pattern"""
+    return [s for s in songs if pattern.search(s["title"]) or pattern.search(s["artist"])]
+
 def extract_video_id(url: str):
     """Extracts video_id from a YouTube link"""
-    pattern = r"(?:v=|youtu\.be/)([A-Za-z0-9_-]+)"
-    match = re.search(pattern, url)
+    match = _VID_RE.search(url)
     if not match:
         raise Exception("Invalid YouTube URL")
     return match.group(1)
 
+def _pick_best(streams: list):
+    """URL of the highest bitrate Piped audio stream, or None"""
+    best = max((s for s in streams if s.get("url")), key=lambda s: s.get("bitrate") or 0, default=None)
+    return best["url"] if best else None
+
+def _piped_failed(prefix: str):
+    """Count a failure; after PIPED_MAX_FAILURES in a row the instance is skipped for a while"""
+    failures = _piped_failures.get(prefix, 0) + 1
+    _piped_failures[prefix] = failures
+    if failures >= PIPED_MAX_FAILURES:
+        _piped_down_until[prefix] = time.monotonic() + PIPED_COOLDOWN
+
+async def _piped_get(prefix: str, video_id: str):
+    """GET prefix + video_id unless the instance is cooling down; None if skipped or not 200"""
+    if _piped_down_until.get(prefix, 0) > time.monotonic():
+        return None
+    try:
+        r = await CLIENT.get(prefix + video_id)
+    except httpx.HTTPError:
+        _piped_failed(prefix)
+        raise
+    if r.status_code >= 500:
+        _piped_failed(prefix)
+    elif r.status_code == 200:
+        _piped_failures.pop(prefix, None)
+        _piped_down_until.pop(prefix, None)
+    return r if r.status_code == 200 else None
+
+async def _fetch_piped_stream(prefix: str, video_id: str):
+    """Ask one Piped instance (by its /streams/ prefix) for the highest bitrate audio stream URL"""
+    r = await _piped_get(prefix, video_id)
+    if r is None:
+        return None
+
+    return _pick_best(orjson.loads(r.content).get("audioStreams") or [])
+
+async def _fetch_piped_metadata(prefix: str, video_id: str):
+    """Ask one Piped instance for a video's title / uploader / thumbnail"""
+    r = await _piped_get(prefix, video_id)
+    if r is None:
+        return None
+
+    data = orjson.loads(r.content)
+    if not data.get("title"):
+        return None
+    return {
+        "title": data["title"],
+        "artist": data.get("uploader") or "Unknown Artist",
+        "thumbnail": data.get("thumbnailUrl") or _THUMB_URL(video_id),
+        "url": _WATCH_URL(video_id),
+    }
+
+async def piped_metadata(video_id: str):
+    """
+    Song entry for a single video from whichever Piped instance answers first.
+    Much lighter than a yt-dlp extraction; returns None if every instance fails.
+    """
+    with _cache_lock:
+        cached = _metadata_cache.get(video_id)
+    if cached is not None:
+        return cached
+
+    tasks = [asyncio.create_task(_fetch_piped_metadata(p, video_id)) for p in _PIPED_PREFIXES]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                song = await next_done
+            except Exception:
+                continue
+            if song:
+                with _cache_lock:
+                    _metadata_cache[video_id] = song
+                return song
+    finally:
+        for t in tasks:
+            t.cancel()
+    return None
+
+def _audio_url_expiry(audio_url: str):
+    """Absolute time at which a resolved audio URL should be dropped from the cache"""
+    now = time.time()
+    ttl = AUDIO_URL_TTL
+    expire = parse_qs(urlparse(audio_url).query).get("expire")
+    if expire and expire[0].isdigit():
+        # Leave a 5 minute margin so clients never receive an already-dead URL
+        ttl = min(int(expire[0]) - now - 300, ttl)
+    return now + ttl
+
+async def resolve_audio_url(video_id: str):
+    """Return a playable audio URL for video_id, cached until shortly before it expires"""
+    with _cache_lock:
+        cached = _audio_url_cache.get(video_id)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    # Singleflight: concurrent requests for the same video share one lookup.
+    # No await between get and set, so no lock is needed on the event loop.
+    task = _inflight_resolves.get(video_id)
+    if task is None:
+        task = asyncio.create_task(_resolve_and_cache(video_id))
+        _inflight_resolves[video_id] = task
+        task.add_done_callback(lambda _: _inflight_resolves.pop(video_id, None))
+    # Shielded so one client disconnecting does not cancel it for the others
+    return await asyncio.shield(task)
+
+async def _resolve_and_cache(video_id: str):
+    audio_url = await _race_sources(video_id)
+    if audio_url:
+        expires_at = _audio_url_expiry(audio_url)
+        if expires_at > time.time():
+            with _cache_lock:
+                _audio_url_cache[video_id] = (audio_url, expires_at)
+    return audio_url
+
+def _ytdlp_audio_url(video_id: str):
+    """Best audio URL as chosen by yt-dlp's own format selector (blocking)"""
+    info = get_ydl("resolve", _RESOLVE_OPTS).extract_info(_WATCH_URL(video_id), download=False)
+    return info.get("url")
+
+async def extract_audio_url(video_id: str):
+    """Queue a yt-dlp audio extraction for the batcher and wait for its result"""
+    future = asyncio.get_running_loop().create_future()
+    _extract_queue.put_nowait((video_id, future))
+    return await future
+
+async def extract_batcher():
+    """
+    Drain queued extractions in micro-batches (up to EXTRACT_MAX_BATCH within
+    EXTRACT_BATCH_WINDOW). Requests for the same video in one batch share a
+    single extraction. An id is skipped only if all its waiters gave up before
+    its batch was dispatched (e.g. Piped won within the batch window); once
+    started, an extraction runs to completion and holds its YDL_SEM slot.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _extract_queue.get()]
+        deadline = loop.time() + EXTRACT_BATCH_WINDOW
+        while len(batch) < EXTRACT_MAX_BATCH:
+            try:
+                batch.append(await asyncio.wait_for(_extract_queue.get(), max(deadline - loop.time(), 0)))
+            except asyncio.TimeoutError:
+                break
+
+        waiters = {}
+        for video_id, future in batch:
+            waiters.setdefault(video_id, []).append(future)
+        for video_id, futures in waiters.items():
+            # Not awaited: a slow extraction must not hold back the next batch
+            task = asyncio.create_task(_run_extraction(video_id, futures))
+            _extract_tasks.add(task)
+            task.add_done_callback(_extract_tasks.discard)
+
+async def _run_extraction(video_id: str, futures: list):
+    if all(f.done() for f in futures):
+        return
+    try:
+        result = await run_ydl(_ytdlp_audio_url, video_id)
+    except Exception as e:
+        for f in futures:
+            if not f.done():
+                f.set_exception(e)
+        return
+    for f in futures:
+        if not f.done():
+            f.set_result(result)
+
+async def _race_sources(video_id: str):
+    """
+    Hedged lookup: all Piped instances start at once, and yt-dlp joins the race
+    if none of them produced a usable URL within HEDGE_DELAY seconds. Gives up
+    with None after RESOLVE_TIMEOUT seconds.
+    """
+    loop = asyncio.get_running_loop()
+    hedge_at = loop.time() + HEDGE_DELAY
+    give_up_at = loop.time() + RESOLVE_TIMEOUT
+    hedged = False
+    pending = {asyncio.create_task(_fetch_piped_stream(p, video_id)) for p in _PIPED_PREFIXES}
+    try:
+        while pending:
+            timeout = max((give_up_at if hedged else hedge_at) - loop.time(), 0)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result():
+                    return task.result()
+            if hedged and loop.time() >= give_up_at:
+                print(f"[RESOLVE] Timed out after {RESOLVE_TIMEOUT}s for {video_id}")
+                break
+
+            # Piped is slow or every instance already failed -> fire the yt-dlp hedge
+            if not hedged and (not pending or loop.time() >= hedge_at):
+                pending.add(asyncio.create_task(extract_audio_url(video_id)))
+                hedged = True
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
+
 # ------------------------- ENDPOINTS -------------------------
 
+@app.get("/ping")
+async def ping():
+    """Cheap liveness endpoint used by the keep-alive task"""
+    return {"status": "ok"}
+
+
+@app.get("/healthz")
+async def healthz():
+    """yt-dlp load, for autoscaling: extractions running and queued for a slot"""
+    return {"status": "ok", "ydl_running": _ydl_running, "ydl_waiting": _ydl_waiting}
+
+
 @app.post("/search")
-def search_song(request: SearchRequest):
+async def search_song(request: Request):
     """Search songs on YouTube but filter to actual music videos"""
     try:
-        query = request.query.strip()
-        is_youtube_link = "youtube.com" in query or "youtu.be" in query
-
+        # Hot path: read {"query": "..."} directly instead of a Pydantic model
+        body = orjson.loads(await request.body())
+        query = body.get("query") if isinstance(body, dict) else None
+        if not isinstance(query, str):
+            raise Exception("Body must be a JSON object with a string 'query'")
+        query = query.strip()
+        is_youtube_link = _YT_LINK_RE.search(query) is not None
+
+        raw_results = None
         if "spotify.com" in query:
-            meta = get_spotify_metadata(query)
-            raw_results = youtube_search(meta["query"], limit=15)
-        else:
-            raw_results = youtube_search(query, limit=15)
+            # Parse before any network call so malformed links fail fast
+            meta = await get_spotify_metadata(extract_spotify_track_id(query))
+            query = meta["query"]
+        elif is_youtube_link and (match := _VID_RE.search(query)):
+            # Direct video link: Piped already has everything we return
+            song = await piped_metadata(match.group(1))
+            if song:
+                raw_results = [song]
+
+        if raw_results is None:
+            limit = 15 if is_youtube_link else 15 * SEARCH_OVERFETCH
+            raw_results = await search_youtube(query, limit)
 
         # Only filter if it is not a direct YouTube link
         if not is_youtube_link:
-            filtered_results = [
-                song for song in raw_results
-                if any(k in (song["title"] + " " + song["artist"]).lower()
-                       for k in ["music", "song", "audio", "track"])
-            ]
+            filtered_results = filter_music(raw_results, _MUSIC_RE)
         else:
             filtered_results = raw_results
 
@@ -163,51 +692,35 @@ def search_song(request: SearchRequest):
 
 
 @app.get("/popular")
-def get_popular():
+async def get_popular():
     """Fetch trending / popular songs, biased toward Bollywood/Indian music"""
     try:
-        trending_queries = [
-            "Bollywood top hits 2025", "Indian music chart", "Bollywood songs playlist",
-            "Top Hindi songs 2025", "Popular Indian tracks"
-        ]
-        query = random.choice(trending_queries)
-        raw_results = youtube_search(query, limit=15)
-
-        # Filter results to likely music videos
-        filtered_results = [
-            song for song in raw_results
-            if any(k in (song["title"] + " " + song["artist"]).lower() for k in ["music", "song", "audio", "track", "bollywood", "hindi"])
-        ]
-        return {"status": "success", "results": filtered_results[:15]}
+        pool = _popular_pool
+        if not pool:
+            # Background refresh has not run yet
+            pool = await build_feed(random.choice(TRENDING_QUERIES), 15)
+        return {"status": "success", "results": random.sample(pool, min(15, len(pool)))}
 
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Popular fetch failed: {str(e)}")
 
 
 @app.get("/recommendations")
-def get_recommendations():
+async def get_recommendations():
     """Provide music recommendations, biased toward relaxing / Bollywood / Indian songs"""
     try:
-        base_queries = [
-            "Bollywood romantic songs", "Relaxing Hindi music", "Indian pop hits",
-            "Bollywood trending songs", "Acoustic Hindi covers", "Top Hindi tracks"
-        ]
-        query = random.choice(base_queries)
-        raw_results = youtube_search(query, limit=12)
-
-        # Filter results to likely music videos
-        filtered_results = [
-            song for song in raw_results
-            if any(k in (song["title"] + " " + song["artist"]).lower() for k in ["music", "song", "audio", "track", "bollywood", "hindi"])
-        ]
-        return {"status": "success", "query": query, "results": filtered_results[:12]}
+        query = random.choice(BASE_QUERIES)
+        filtered_results = _recommendations_feed.get(query)
+        if filtered_results is None:
+            filtered_results = _recommendations_feed[query] = await build_feed(query, 12)
+        return {"status": "success", "query": query, "results": filtered_results}
 
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Recommendations failed: {str(e)}")
 
 
 @app.post("/download")
-def download_audio(request: DownloadRequest):
+async def download_audio(request: DownloadRequest):
     """
     Download audio using Piped API (for offline playback).
     Fetches highest bitrate stream and sends as a downloadable file.
@@ -216,27 +729,7 @@ def download_audio(request: DownloadRequest):
         url = request.url.strip()
         video_id = extract_video_id(url)
 
-        # Try multiple Piped instances
-        audio_url = None
-        for instance in PIPED_INSTANCES:
-            try:
-                api_url = f"{instance}/streams/{video_id}"
-                r = requests.get(api_url, timeout=10)
-                if r.status_code != 200:
-                    continue
-
-                data = r.json()
-                audio_streams = data.get("audioStreams", [])
-                if not audio_streams:
-                    continue
-
-                # Choose the best available audio stream
-                best_stream = sorted(audio_streams, key=lambda x: x.get("bitrate", 0))[-1]
-                audio_url = best_stream["url"]
-                break
-            except:
-                continue
-
+        audio_url = await resolve_audio_url(video_id)
         if not audio_url:
             raise Exception("No audio streams found for download.")
 
@@ -245,14 +738,16 @@ def download_audio(request: DownloadRequest):
         filename = f"rhymes_{video_id}_{random.randint(1000, 9999)}.webm"
         filepath = os.path.join("downloads", filename)
 
-        # Stream download & save to temp folder
-        with requests.get(audio_url, stream=True) as r:
-            r.raise_for_status()
-            with open(filepath, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024 * 64):
-                    if chunk:
+        # Stream download & save to temp folder (off the event loop)
+        def fetch_to_file():
+            with SYNC_CLIENT.stream("GET", audio_url, timeout=None) as r:
+                r.raise_for_status()
+                with open(filepath, "wb") as f:
+                    for chunk in r.iter_bytes(chunk_size=1024 * 64):
                         f.write(chunk)
 
+        await asyncio.to_thread(fetch_to_file)
+
         # Stream file back to user
         def iterfile():
             with open(filepath, "rb") as f:
@@ -272,44 +767,22 @@ def download_audio(request: DownloadRequest):
 
 
 @app.get("/stream")
-def stream_audio(url: str):
+async def stream_audio(url: str):
     """
-    Streams audio using Piped API (stable, no YouTube restrictions)
+    Streams audio using Piped API (stable, no YouTube restrictions),
+    with yt-dlp as a hedged fallback
     """
     try:
         video_id = extract_video_id(url)
 
-        audio_url = None
-
-        # Try multiple Piped instances to avoid downtime
-        for instance in PIPED_INSTANCES:
-            try:
-                api_url = f"{instance}/streams/{video_id}"
-                r = requests.get(api_url, timeout=10)
-                
-                if r.status_code != 200:
-                    continue
-                
-                data = r.json()
-                audio_streams = data.get("audioStreams", [])
-
-                if not audio_streams:
-                    continue
-
-                # Choose highest quality audio
-                best_stream = sorted(audio_streams, key=lambda x: x.get("bitrate", 0))[-1]
-                audio_url = best_stream["url"]
-                break
-            except:
-                continue
-
+        audio_url = await resolve_audio_url(video_id)
         if not audio_url:
-            raise Exception("No audio streams available from any Piped instance.")
+            raise Exception("No audio streams available from Piped or yt-dlp.")
 
         def iterfile():
-            with requests.get(audio_url, stream=True) as r:
+            with SYNC_CLIENT.stream("GET", audio_url, timeout=None) as r:
                 r.raise_for_status()
-                for chunk in r.iter_content(1024 * 64):
+                for chunk in r.iter_bytes(1024 * 64):
                     yield chunk
 
         return StreamingResponse(iterfile(), media_type="audio/webm")
@@ -318,23 +791,106 @@ def stream_audio(url: str):
         raise HTTPException(status_code=400, detail=f"Streaming failed: {str(e)}")
 
 
+# -------------------- FEED REFRESH --------------------
+# /popular and /recommendations are served from these, refilled in the background
+FEED_REFRESH_INTERVAL = 60 * 60
+POPULAR_RESULTS_PER_QUERY = 20
+# Background refreshes take at most this many yt-dlp slots, leaving the rest
+# of YDL_MAX_CONC free for user searches and /stream fallbacks
+FEED_REFRESH_CONC = int(os.getenv("FEED_REFRESH_CONC", "1"))
+_feed_refresh_sem = None  # asyncio.Semaphore(FEED_REFRESH_CONC), created in lifespan
+
+async def _refresh_query(feed: dict, query: str, limit: int):
+    try:
+        async with _feed_refresh_sem:
+            feed[query] = await build_feed(query, limit, use_cache=False)
+    except Exception as e:
+        print(f"[FEED] Refresh failed for {query!r}: {e}")
+
+async def refresh_feeds():
+    """Re-run every popular / recommendation query, FEED_REFRESH_CONC at a time, then sleep, forever"""
+    global _popular_pool
+    while True:
+        await asyncio.gather(
+            *(_refresh_query(_popular_feed, q, POPULAR_RESULTS_PER_QUERY) for q in TRENDING_QUERIES),
+            *(_refresh_query(_recommendations_feed, q, 12) for q in BASE_QUERIES),
+        )
+        # One deduplicated pool across all trending queries; /popular samples from it
+        unique = {}
+        for songs in _popular_feed.values():
+            for song in songs:
+                unique.setdefault(song["url"], song)
+        _popular_pool = list(unique.values())
+        await asyncio.sleep(FEED_REFRESH_INTERVAL)
+
+
 # -------------------- PING SERVER KEEP-ALIVE --------------------
-import threading
-import time
 
 # ✅ Load from .env or Render environment variables
 PING_URL = os.getenv("PING_URL", "http://localhost:8000")
 
-def keep_server_awake():
-    """Ping the server every 14 minutes to prevent Render free tier sleep."""
+PING_INTERVAL = 14 * 60  # Render free tier sleeps after 15 minutes idle
+_last_request_at = time.monotonic()
+
+def track_last_request(app):
+    """Pure ASGI middleware recording when this worker last saw an HTTP request"""
+    async def middleware(scope, receive, send):
+        global _last_request_at
+        if scope["type"] == "http":
+            _last_request_at = time.monotonic()
+        await app(scope, receive, send)
+    return middleware
+
+app.add_middleware(track_last_request)
+
+_keep_awake_stop = None  # asyncio.Event, created in lifespan
+_keep_awake_lock_file = None
+
+def claim_keep_awake():
+    """
+    Only one worker process needs to ping: the first one to take an exclusive
+    lock on a shared lock file wins and holds it for its lifetime.
+    """
+    global _keep_awake_lock_file
+    try:
+        import fcntl
+    except ImportError:  # Windows: assume a single worker
+        return True
+
+    _keep_awake_lock_file = open(os.path.join(tempfile.gettempdir(), "serena-keep-awake.lock"), "w")
+    try:
+        fcntl.flock(_keep_awake_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        _keep_awake_lock_file.close()
+        _keep_awake_lock_file = None
+        return False
+
+def release_keep_awake():
+    """Drop the keep-alive lock so a later lifespan (or another worker) can claim it"""
+    global _keep_awake_lock_file
+    if _keep_awake_lock_file is not None:
+        _keep_awake_lock_file.close()
+        _keep_awake_lock_file = None
+
+async def keep_server_awake():
+    """Ping the server once it has been idle for 14 minutes to prevent Render free tier sleep."""
+    last_ping = time.monotonic()
     while True:
+        # Real traffic keeps the instance awake too, so only ping once
+        # PING_INTERVAL has passed since the later of the two
+        delay = max(_last_request_at, last_ping) + PING_INTERVAL - time.monotonic()
+        if delay > 0:
+            try:
+                # Returns early (and ends the loop) as soon as shutdown is signalled
+                await asyncio.wait_for(_keep_awake_stop.wait(), timeout=delay)
+                return
+            except asyncio.TimeoutError:
+                continue  # re-check: a request may have arrived meanwhile
+        last_ping = time.monotonic()
         try:
             print("[PING] Sending keep-alive ping...")
-            response = requests.get(f"{PING_URL}/recommendations", timeout=10)
+            response = await CLIENT.get(f"{PING_URL}/ping", timeout=10)
             print(f"[PING] Status: {response.status_code}")
         except Exception as e:
             print(f"[PING] Failed: {e}")
-        time.sleep(14 * 60)  # wait 14 minutes
-
-# Start background thread
-threading.Thread(target=keep_server_awake, daemon=True).start()